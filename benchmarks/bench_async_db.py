@@ -0,0 +1,80 @@
+"""
+قياس معدل معالجة التحديثات مع تأخير محاكى لقاعدة البيانات.
+
+يقارن بين استدعاء دوال قاعدة البيانات المتزامنة مباشرة داخل المعالج (الطريقة القديمة)
+وبين تمريرها عبر run_db (مجمع الخيوط المحدود)، مع قياس تأخر نبضة العداد
+التي تمثل update_timer.
+
+الاستخدام:
+    python benchmarks/bench_async_db.py [عدد_التحديثات] [تأخير_الاستعلام_بالميلي_ثانية]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bot  # noqa: E402
+
+QUERIES_PER_UPDATE = 4  # مثل /smoke: الهاتف، الموظف، آخر سيجارة، العدد
+
+
+def simulated_query(latency):
+    time.sleep(latency)
+    return True
+
+
+async def handle_update_blocking(latency):
+    for _ in range(QUERIES_PER_UPDATE):
+        simulated_query(latency)
+
+
+async def handle_update_async(latency):
+    for _ in range(QUERIES_PER_UPDATE):
+        await bot.run_db(simulated_query, latency)
+
+
+async def ticker(stop, lags):
+    """نبضة كل 100ms لقياس مدى حجب حلقة الأحداث"""
+    interval = 0.1
+    expected = time.perf_counter() + interval
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        lags.append(now - expected)
+        expected = now + interval
+
+
+async def run(handler, updates, latency):
+    semaphore = asyncio.Semaphore(bot.CONCURRENT_UPDATES)
+    stop = asyncio.Event()
+    lags = []
+    tick = asyncio.create_task(ticker(stop, lags))
+
+    async def one():
+        async with semaphore:
+            await handler(latency)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(updates)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick
+    return elapsed, max(lags) if lags else 0.0
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+
+    print(f"updates={updates} latency={latency * 1000:.0f}ms queries/update={QUERIES_PER_UPDATE} "
+          f"concurrent_updates={bot.CONCURRENT_UPDATES} db_workers={bot.DB_POOL_MAX}")
+    for label, handler in (("blocking (before)", handle_update_blocking), ("run_db (after)", handle_update_async)):
+        elapsed, max_lag = asyncio.run(run(handler, updates, latency))
+        print(f"{label:>18}: {updates / elapsed:8.1f} updates/s  total={elapsed:6.2f}s  max timer lag={max_lag * 1000:7.1f}ms")
+    bot.db_executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+قياس مسار فك بيانات أزرار الطلبات وتوجيهها.
+
+يقارن بين الصيغة النصية القديمة (split('_') وسلسلة if/elif ثم البحث عن الموظف
+في employee_cache) وبين الترميز المضغوط الحالي (decode_callback ثم جدول CALLBACK_HANDLERS
+وسياق الطلب من approval_contexts). لا يشمل زمن قاعدة البيانات في الحالتين.
+
+الاستخدام:
+    python benchmarks/bench_callback_data.py [عدد_التكرارات]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bot  # noqa: E402
+
+TELEGRAM_ID = 1465191277
+REQUEST_ID = 123456
+
+
+# --- التطبيق القديم (للمقارنة فقط) ---
+def legacy_dispatch(data):
+    parts = data.split('_')
+    action = parts[0]
+    if action == "returned":
+        return action, parts[1], int(parts[2])
+    type_ = parts[1]
+    target_id = int(parts[2])
+    emp = bot.employee_cache.get_by_telegram_id(target_id)
+    if action == "approve":
+        return action, type_, emp
+    elif action == "reject":
+        return action, type_, emp
+
+
+def compact_dispatch(data):
+    action, request_id = bot.decode_callback(data)
+    return bot.CALLBACK_HANDLERS[action], bot.approval_contexts.get(request_id)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+    bot.employee_cache.put({'id': 1, 'telegram_id': TELEGRAM_ID, 'phone_number': '962786644106', 'full_name': 'موظف'})
+    bot.remember_approval_context(bot.ApprovalContext(REQUEST_ID, TELEGRAM_ID, 'smoke', 1, 'موظف'))
+
+    legacy_data = f"approve_smoke_{TELEGRAM_ID}"
+    compact_data = bot.encode_callback('approve', REQUEST_ID)
+    assert compact_dispatch(compact_data)[1].telegram_id == TELEGRAM_ID
+
+    print(f"callback_data: legacy={len(legacy_data.encode())} bytes  compact={len(compact_data.encode())} bytes "
+          f"(max request id {len(bot.encode_callback('approve', 2 ** 64 - 1).encode())} bytes, limit 64)")
+    for label, func, data in (("legacy split", legacy_dispatch, legacy_data),
+                              ("compact", compact_dispatch, compact_data)):
+        elapsed = min(timeit.repeat(lambda: func(data), number=number, repeat=5))
+        print(f"{label:>13}: {elapsed / number * 1e9:8.0f} ns/decision")
+    bot.db_executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+قياس تصدير السجلات (write_export_archive) على مليون صف مصطنع.
+
+يقيس الزمن وأقصى ذاكرة مخصصة في Python (tracemalloc) وحجم الملف المضغوط،
+لإظهار أن الذاكرة ثابتة مهما كان عدد الصفوف (tracemalloc يبطئ التنفيذ، فالزمن هنا حد أعلى).
+
+الاستخدام:
+    python benchmarks/bench_export.py [عدد_الصفوف]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bot  # noqa: E402
+
+
+def synthetic_cigarette_rows(count):
+    start = datetime(2025, 1, 1, 10, tzinfo=bot.JORDAN_TZ)
+    for i in range(count):
+        yield (i + 1, f"موظف {i % 2000}", f"9627{i % 2000:08d}", start + timedelta(seconds=37 * i))
+
+
+def run(rows):
+    tables = [
+        ('cigarette_times', ['id', 'full_name', 'phone_number', 'taken_at'], synthetic_cigarette_rows(rows)),
+    ]
+    with tempfile.TemporaryFile() as fileobj:
+        tracemalloc.start()
+        started = time.perf_counter()
+        counts = bot.write_export_archive(fileobj, tables)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        size = fileobj.seek(0, os.SEEK_END)
+    return counts['cigarette_times'], elapsed, peak, size
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    for n in (rows // 10, rows):
+        count, elapsed, peak, size = run(n)
+        print(f"rows={count:>9}  time={elapsed:6.2f}s  rows/s={count / elapsed:9.0f}  "
+              f"peak python memory={peak / 1024:8.1f} KiB  zip size={size / 1024 / 1024:6.2f} MiB")
+    bot.db_executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
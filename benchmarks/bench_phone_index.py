@@ -0,0 +1,65 @@
+"""
+قياس بناء فهرس الهواتف المصرح لها والتحقق منه.
+
+يقارن بين القائمة القديمة (إضافة مع فحص `not in` ومسح خطي مع normalize_phone لكل عنصر)
+وبين الفهرس الحالي authorized_phones (مجموعة هواتف موحدة).
+
+الاستخدام:
+    python benchmarks/bench_phone_index.py [عدد_الموظفين] [عدد_عمليات_التحقق]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bot  # noqa: E402
+
+
+# --- التطبيق القديم (للمقارنة فقط) ---
+def legacy_add(phones, phone_number):
+    if not phone_number.startswith('+'): phone_number = '+' + phone_number
+    if phone_number not in phones:
+        phones.append(phone_number)
+
+
+def legacy_verify(phones, phone_number):
+    normalized_input = bot.normalize_phone(phone_number)
+    for auth_phone in phones:
+        if bot.normalize_phone(auth_phone) == normalized_input:
+            return True
+    return False
+
+
+def timed(func):
+    started = time.perf_counter()
+    result = func()
+    return time.perf_counter() - started, result
+
+
+def main():
+    employees = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    checks = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    phones = [f"9627{n:08d}" for n in random.sample(range(10 ** 8), employees)]
+    probes = [f"+{random.choice(phones)}" for _ in range(checks // 2)]
+    probes += [f"00962{n:07d}" for n in range(checks - len(probes))]  # أرقام غير مسجلة
+
+    print(f"employees={employees} checks={checks}")
+
+    legacy = []
+    build_old, _ = timed(lambda: [legacy_add(legacy, p) for p in phones])
+    verify_old, _ = timed(lambda: [legacy_verify(legacy, p) for p in probes])
+
+    bot.authorized_phones.clear()
+    build_new, _ = timed(lambda: bot.authorized_phones.update(bot.normalize_phone(p) for p in phones))
+    verify_new, _ = timed(lambda: [bot.verify_employee(p) for p in probes])
+
+    print(f"{'startup build':>14}: list {build_old:9.3f}s   index {build_new:9.4f}s")
+    print(f"{'verify (each)':>14}: list {verify_old / checks * 1e3:9.3f}ms  index {verify_new / checks * 1e6:9.2f}us")
+    bot.db_executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()